@@ -1,6 +1,21 @@
 #!/usr/bin/python3
 import requests
 import logging
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx  # optional, only needed by `AsyncKimikuriClient`
+except ImportError:
+    httpx = None
+
+DEFAULT_API_ROOT = 'https://kimikuri.keuin.cc/api/'
+SUCCESS_RESPONSE_BODY = b'{"success":true}'  # what the server responds in the common case
+
+
+def _normalize_api_root(api_root: str = None) -> str:
+    if api_root and not api_root.endswith('/'):
+        api_root += '/'
+    return api_root if api_root and len(api_root) > len('http://') else DEFAULT_API_ROOT
 
 
 class KimikuriClient:
@@ -14,25 +29,101 @@ class KimikuriClient:
         :param api_root: the Kimikuri server api URL. Official API (from Keuin) is the default.
         :param token: the token for your Telegram account on Kimikuri.
         """
-        if api_root and not api_root.endswith('/'):
-            api_root += '/'
-        self.__api_root = api_root if api_root and len(api_root) > len('http://') else 'https://kimikuri.keuin.cc/api/'
+        self.__api_root = _normalize_api_root(api_root)
         self.__token = token
         self.__logger = logging.getLogger(KimikuriClient.__name__)
+        # reuse connections (keep-alive) across messages, instead of a new TCP+TLS handshake per call
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=20)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        Close the underlying HTTP session and release pooled connections.
+        """
+        self.__session.close()
 
     def send_message(self, message: str, **kwargs) -> bool:
         """
         Let Kimikuri send you a message.
         :param message: the message text.
-        :param kwargs: other arguments passed to requests.get method. (note that `url` and `params` are already used)
+        :param kwargs: other arguments passed to requests.Session.get method. (note that `url` and `params` are already used)
         :return: if success
         """
-        r = requests.get(self.__api_root + 'message', params={'token': self.__token, 'message': message}, **kwargs)
+        r = self.__session.get(self.__api_root + 'message', params={'token': self.__token, 'message': message}, **kwargs)
 
         if r.status_code != 200:
             self.__logger.error(f'Bad HTTP status code: {r.status_code}')
             return False
 
+        if r.content == SUCCESS_RESPONSE_BODY:
+            return True  # fast path, skip parsing JSON
+
+        try:
+            return r.json().get('success') is True
+        except ValueError:
+            self.__logger.error(f'Bad response: {r.text}')
+            return False  # not a valid json
+
+
+class AsyncKimikuriClient:
+    """
+    An asynchronous Kimikuri API wrapper, based on httpx.
+    Concurrent sends are multiplexed over a shared HTTP/2 connection pool.
+    Requires `httpx` with HTTP/2 support (`pip install httpx[http2]`).
+    """
+
+    def __init__(self, token: str, api_root: str = None):
+        """
+        Initialize an asynchronous Kimikuri client instance.
+        :param api_root: the Kimikuri server api URL. Official API (from Keuin) is the default.
+        :param token: the token for your Telegram account on Kimikuri.
+        """
+        if httpx is None:
+            raise ImportError('httpx is required by AsyncKimikuriClient.')
+        self.__token = token
+        self.__logger = logging.getLogger(AsyncKimikuriClient.__name__)
+        self.__client = httpx.AsyncClient(
+            http2=True,
+            base_url=_normalize_api_root(api_root),
+            limits=httpx.Limits(max_keepalive_connections=8, max_connections=32)
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+    async def aclose(self):
+        """
+        Close the underlying HTTP client and release pooled connections.
+        """
+        await self.__client.aclose()
+
+    async def send_message(self, message: str, **kwargs) -> bool:
+        """
+        Let Kimikuri send you a message.
+        :param message: the message text.
+        :param kwargs: other arguments passed to httpx.AsyncClient.get method. (note that `url` and `params` are already used)
+        :return: if success
+        """
+        r = await self.__client.get('message', params={'token': self.__token, 'message': message}, **kwargs)
+
+        if r.status_code != 200:
+            self.__logger.error(f'Bad HTTP status code: {r.status_code}')
+            return False
+
+        if r.content == SUCCESS_RESPONSE_BODY:
+            return True  # fast path, skip parsing JSON
+
         try:
             return r.json().get('success') is True
         except ValueError:
@@ -41,47 +132,21 @@ class KimikuriClient:
 
 
 if __name__ == '__main__':
-    def __print_help_menu():
-        print('Kimikuri Client CLI')
-        print('You can import this module and use `KimikuriClient` programmatically.')
-        print('Or use this script as a CLI tool instead:')
-        print('kuriclient.py [--api-root <api_root>] --token <your_token> --message <message>')
-
-
-    import sys
-
-    args = sys.argv[1:]
-    api_root = ''
-    token = ''
-    message = ''
-    valid = True  # if the parsing termination state is valid
-    is_switch = True  # if current token is a switch, rather than a data
-    try:
-        for i, t in enumerate(args):
-            if is_switch:
-                if t == '--api-root':
-                    api_root = args[i + 1]
-                if t == '--token':
-                    token = args[i + 1]
-                elif t == '--message':
-                    message = args[i + 1]
-                else:
-                    # not a valid switch. Just print the help menu.
-                    valid = False
-                    break
-                is_switch = False  # a valid switch. Next token is a data.
-            else:
-                #  a data. Skip it.
-                is_switch = True
-    except IndexError:
-        valid = False
-
-    if valid and token and message:
-        if not KimikuriClient(api_root=api_root, token=token).send_message(message):
-            print('Failed to send message.')
-            exit(-10)
-        else:
-            exit(0)
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Kimikuri Client CLI',
+        epilog='You can also import this module and use `KimikuriClient` programmatically.'
+    )
+    parser.add_argument('--api-root', default='', help='the Kimikuri server api URL. Official API is the default.')
+    parser.add_argument('--token', required=True, help='the token for your Telegram account on Kimikuri.')
+    parser.add_argument('--message', required=True, help='the message text.')
+    args = parser.parse_args()
+
+    with KimikuriClient(api_root=args.api_root, token=args.token) as client:
+        success = client.send_message(args.message)
+    if not success:
+        print('Failed to send message.')
+        exit(-10)
     else:
-        __print_help_menu()
-        exit()
+        exit(0)
@@ -1,20 +1,32 @@
+import asyncio
+import atexit
 import logging.config
 import os
 import platform
+import signal
 import sys
-from logging import StreamHandler, FileHandler, Formatter
-from queue import Queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from logging import StreamHandler
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full, Empty
 from threading import Thread, Event
 from typing import IO
 
 import fastapi
+import orjson
 import uvicorn
-from fastapi import FastAPI
+import uvloop
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
 from starlette.responses import HTMLResponse
 from telegram import Bot, Update
 from telegram.ext import Updater, CallbackContext, Dispatcher
 from telegram.utils.request import Request
 
+from kuri.buffered_file_handler import BufferedFileHandler
+from kuri.cached_time_formatter import CachedTimeFormatter
 from kuri.command_register import CommandRegister
 from kuri.database import KuriDatabase
 from kuri.kuri_config import KuriConfig
@@ -33,17 +45,37 @@ KURI_VERSION_SUFFIX = 'alpha'
 # some of them can be set by environment variables:
 #   KURI_CONFIG_FILE
 #   KURI_USERS_DB_FILE
+#   KURI_USERS_WAL_FILE
 #   KURI_LOG_FILE
 #   KURI_WEBHOOK_SECRET_LENGTH
 #   KURI_TOKEN_SIZE_BYTES
 
 CONFIG_FILE = os.environ.get('KURI_CONFIG_FILE') or 'kimikuri.json'
 USER_DB_FILE = os.environ.get('KURI_USERS_DB_FILE') or 'users.json'
+USER_WAL_FILE = os.environ.get('KURI_USERS_WAL_FILE') or USER_DB_FILE + '.wal'
 LOG_FILE = os.environ.get('KURI_LOG_FILE') or 'kimikuri.log'
-WEBHOOK_SECRET_LENGTH = os.environ.get('KURI_WEBHOOK_SECRET_LENGTH') or 32
-TOKEN_SIZE_BYTES = os.environ.get('KURI_TOKEN_SIZE_BYTES') or 32
+WEBHOOK_SECRET_LENGTH = int(os.environ.get('KURI_WEBHOOK_SECRET_LENGTH') or 32)
+TOKEN_SIZE_BYTES = int(os.environ.get('KURI_TOKEN_SIZE_BYTES') or 32)
 API_SEND_MESSAGE = os.environ.get('KURI_API_SEND_MESSAGE_NAME') or 'message'
 
+# every registration is durable in the WAL at once,
+# so the database snapshot is only rewritten (compacted) at most once per interval
+COMPACTION_INTERVAL_SECONDS = 3600
+COMPACTION_WAL_RECORDS = 100  # compact at once if the WAL has grown to this many records
+
+LOG_FLUSH_INTERVAL_SECONDS = 2  # max delay before buffered log records are written into the log file
+
+OUTBOX_BATCH_SIZE = 50  # max count of messages collected in one batch
+OUTBOX_WINDOW_SECONDS = 0.2  # max time to wait for more messages after the first one in a batch
+OUTBOX_DRAIN_TIMEOUT_SECONDS = 5  # max time to wait for queued messages to be sent when shutting down
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096  # in UTF-16 code units
+
+# connections used by python-telegram-bot itself (polling and dispatcher workers),
+# the optimal value of `telegram.ext.Updater` with its default 4 workers
+BOT_FRAMEWORK_CON_POOL_SIZE = 8
+# update types the bot handles, Telegram does not deliver the others at all
+BOT_ALLOWED_UPDATES = ['message']
+
 DEBUG_HOST = "0.0.0.0"
 DEBUG_PORT = 7777
 
@@ -77,18 +109,37 @@ __original_uncaught_exception_handler = sys.excepthook
 sys.excepthook = __uncaught_exception_handler
 
 # set log handlers (to file & stderr)
-log_formatter = Formatter('[%(asctime)s][%(name)s][%(levelname)s] %(message)s')
+log_formatter = CachedTimeFormatter('[%(asctime)s][%(name)s][%(levelname)s] %(message)s')
 
 console_handler = StreamHandler()
 console_handler.setLevel(log_level)
 console_handler.setFormatter(log_formatter)
 
-file_handler = FileHandler(LOG_FILE)
+# errors are written into the file at once, others are flushed periodically by `__flush_log_loop`
+file_handler = BufferedFileHandler(LOG_FILE, flush_level=logging.ERROR)
 file_handler.setLevel(log_level)
 file_handler.setFormatter(log_formatter)
 
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+# format and write records in a background thread,
+# so logging never blocks the event loop or the bot threads on console or disk I/O
+log_queue = Queue()
+log_listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)  # flush queued records before quitting
+
+logger.addHandler(QueueHandler(log_queue))
+
+
+def __flush_log_loop():
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL_SECONDS)
+        file_handler.flush()
+
+
+log_flush_thread = Thread(target=__flush_log_loop)
+log_flush_thread.setName('LogFlushThread')
+log_flush_thread.setDaemon(True)
+log_flush_thread.start()
 
 # initialize config after the logger is initialized,
 # to save log of uncaught exceptions into file
@@ -116,31 +167,39 @@ print(f'Set log level to {log_level}.')
 if os.path.isfile(USER_DB_FILE):
     try:
         # load database form file
-        with open(USER_DB_FILE, 'r', encoding='utf-8') as f:
-            database = KuriDatabase.from_file(f)
-        logger.debug(f'Loaded {sum(1 for _ in database.get_users())} user(s) into memory.')
+        with open(USER_DB_FILE, 'rb') as f:
+            database = KuriDatabase.from_file(f, wal_file_name=USER_WAL_FILE)
+        logger.debug(f'Loaded {len(database)} user(s) into memory.')
     except IOError as e:
         logger.error(f'Failed to load database file `{USER_DB_FILE}`: {e}')
         exit(ERR_FAILED_TO_LOAD_DATABASE)
 else:
-    database = KuriDatabase()
+    database = KuriDatabase(wal_file_name=USER_WAL_FILE)
     logger.debug(f'User database file does not exist. Create an empty one.')
 
-__save_database_loop_interrupt_event = Event()  # used to interrupt loop in `__save_database_loop`
+
+def __save_database():
+    __logger = logger.getChild('database-save-loop')
+    try:
+        if database.is_dirty():
+            database.save(USER_DB_FILE)
+            __logger.info('Saved the database.')
+    except IOError as e:
+        __logger.error(f'Failed to save database to file `{USER_DB_FILE}`: {e}')
 
 
 def __save_database_loop():
     __logger = logger.getChild('database-save-loop')
     __logger.debug('Thread starting...')
     while kimikuri_running:
-        __save_database_loop_interrupt_event.wait(10)
-        try:
-            if database.is_dirty():
-                with open(USER_DB_FILE, 'w', encoding='utf-8') as f:
-                    database.to_file(f)
-                __logger.info('Saved the database.')
-        except IOError as e:
-            __logger.error(f'Failed to save database to file `{USER_DB_FILE}`: {e}')
+        database.wait_dirty()  # sleep until something changes
+        # coalesce modifications into one snapshot write, unless there are too many of them
+        deadline = time.monotonic() + COMPACTION_INTERVAL_SECONDS
+        while database.get_wal_record_count() < COMPACTION_WAL_RECORDS:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0 or not database.wait_dirty(timeout):
+                break
+        __save_database()
     __logger.debug('Thread stopped.')
 
 
@@ -153,22 +212,23 @@ db_save_thread.start()
 token_manager = TokenManager(database, TOKEN_SIZE_BYTES)
 
 # initialize FastAPI core
-webapi = FastAPI()
+webapi = FastAPI(default_response_class=ORJSONResponse)
 
 # initialize bot and telegram framework
 proxy_url = config.get_proxy_address()
 if proxy_url:
     logger.info(f'Using proxy {proxy_url} to connect to Telegram API.')
+# the connection pool is shared by message senders and python-telegram-bot itself,
+# size it so that all of them can keep their connections alive, instead of handshaking for new ones
 bot = Bot(token=config.get_bot_token(), request=Request(
     proxy_url=proxy_url,
-    con_pool_size=config.get_pool_connection_size(),
+    con_pool_size=config.get_pool_connection_size() + BOT_FRAMEWORK_CON_POOL_SIZE,
     connect_timeout=config.get_bot_connect_timeout_seconds(),
     read_timeout=config.get_bot_read_timeout_seconds()
 ))
 
-logger.info('Connecting to Telegram...')
-
-logger.info(f'Recognized bot as {bot.get_me().username}.')
+# threads sending outgoing messages, each of them owns a pooled connection
+sender_executor = ThreadPoolExecutor(max_workers=config.get_pool_connection_size(), thread_name_prefix='MessageSender')
 
 # generate secret and bind webhook (even if it is not used, for convince and secure reason)
 webhook_secret = str(generate_secret(WEBHOOK_SECRET_LENGTH), encoding='ascii')
@@ -177,26 +237,32 @@ logger.debug(f'WebHook secret ({len(webhook_secret)}): {webhook_secret}')
 if config.use_webhook():
     logger.info('Setting up bot in WebHook mode...')
     # Create bot, update queue and dispatcher instances
-    webhook_update_queue = Queue()
+    # bounded, so a stalled dispatcher pushes back on Telegram (which retries later) instead of eating memory
+    webhook_update_queue = Queue(maxsize=config.get_webhook_queue_size())
     dispatcher = Dispatcher(bot, webhook_update_queue)
     updater = None  # to eliminate IDE warning
 else:
     logger.info('Setting up bot in polling mode...')
-    updater = Updater(bot=bot, use_context=True, request_kwargs={
-        'proxy_url': proxy_url
-    } if proxy_url else None)
+    updater = Updater(bot=bot, use_context=True)  # uses the connection pool (and proxy) of `bot`
     dispatcher = updater.dispatcher
     webhook_update_queue = None  # to eliminate IDE warning
 
 # register command handlers
 command_register = CommandRegister(dispatcher)
 
+# constant bot replies, built once
+REGISTER_REPLY_TEMPLATE = 'Your token: {token}\nTreat this as a password!'
+HOWTO_REPLY = 'First, get your token by using `/register`.\n' \
+              f'Then, GET or POST on {config.get_api_base()}{API_SEND_MESSAGE} with parameter ' \
+              '`token` and `message`.\n' \
+              'Finally, Kimikuri will repeat that message to you, via Telegram!'
+
 
 @command_register.user_command('start', 'show this help menu')
 def start(update: Update, context: CallbackContext):
     context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="Hello, this is Kimikuri!\n" + command_register.get_manual_string()
+        text=START_REPLY
     )
     # context.bot.send_message(chat_id=update.effective_chat.id, text=str(update))
 
@@ -206,17 +272,17 @@ def register(update: Update, context: CallbackContext):
     sender_id = update['message']['from_user']['id']
     chat_id = update['message']['chat_id']
 
-    logger.debug(f'User {sender_id} want to register.')
+    logger.debug('User %s want to register.', sender_id)
     if user := database.get_user(user_id=sender_id):
         token = user.token
-        logger.debug(f'The user has already registered. Previous token: {token}')
+        logger.debug('The user has already registered. Previous token: %s', token)
     else:
         token = token_manager.generate_unused_token()
         database.register(user_id=sender_id, token=token, chat_id=chat_id)
-        logger.debug(f'Registered user {sender_id} with chat_id={chat_id}, token={token}')
+        logger.debug('Registered user %s with chat_id=%s, token=%s', sender_id, chat_id, token)
     context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=f'Your token: {token}\nTreat this as a password!'
+        text=REGISTER_REPLY_TEMPLATE.format(token=token)
     )
 
 
@@ -224,29 +290,124 @@ def register(update: Update, context: CallbackContext):
 def howto(update: Update, context: CallbackContext):
     context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text='First, get your token by using `/register`.\n' +
-             f'Then, GET or POST on {config.get_api_base()}{API_SEND_MESSAGE} with parameter ' +
-             '`token` and `message`.\n' +
-             'Finally, Kimikuri will repeat that message to you, via Telegram!'
+        text=HOWTO_REPLY
     )
 
 
+# the manual lists all commands, so it is complete only after the last one is registered
+START_REPLY = 'Hello, this is Kimikuri!\n' + command_register.get_manual_string()
+
+
+def __webhook_dispatch_loop():
+    """
+    Parse and dispatch raw updates received by the webhook,
+    so that the event loop does not spend time on building `Update` objects.
+    """
+    __logger = logger.getChild('webhook-dispatch-loop')
+    __logger.debug('Thread starting...')
+    while kimikuri_running:
+        try:
+            json_body = webhook_update_queue.get(timeout=1)  # wake up regularly to check the running flag
+        except Empty:
+            continue
+        try:
+            dispatcher.process_update(Update.de_json(json_body, bot))
+        except Exception as e:
+            __logger.error('Failed to dispatch WebHook update: %s', e)
+    __logger.debug('Thread stopped.')
+
+
 # start webhook dispatcher thread
 if config.use_webhook():
-    webhook_dispatcher_thread = Thread(target=dispatcher.start, name='WebHookInBoundDispatcher')
+    webhook_dispatcher_thread = Thread(target=__webhook_dispatch_loop, name='WebHookInBoundDispatcher')
     webhook_dispatcher_thread.start()
 
 
 # internal APIs
 
+outbox = None  # queue of (chat_id, message) to be sent, created with the event loop on startup
+outbox_pump_task = None  # the task sending messages in the outbox
+
+
 def notify(token: str, message: str) -> bool:
-    user = database.get_user(token=token)
-    if user:
-        logger.info(f'Offer user {user.user_id} (chat_id={user.chat_id}) message {message}')
-        bot.send_message(chat_id=user.chat_id, text=message)
-        return True
-    else:
-        logger.info(f'Invalid token {token}')
+    """
+    Queue a message to the user owning the given token.
+    Must be called from the event loop thread.
+    :return: if the token is valid and the message will be sent.
+    """
+    chat_id = database.chat_id_for(token)
+    if chat_id is None:
+        logger.info('Invalid token %s', token)
+        return False
+    if outbox_pump_task.done():
+        logger.error('Outbox pump is not running, refused message to chat %s.', chat_id)
+        return False
+    logger.info('Offer chat %s message %s', chat_id, message)
+    outbox.put_nowait((chat_id, message))
+    return True
+
+
+def __utf16_length(text: str) -> int:
+    """
+    Length of the text as Telegram counts it, in UTF-16 code units.
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+
+def __merge_messages(batch):
+    """
+    Join messages to the same chat with newlines, keeping their order and Telegram's length limit.
+    :return: dict of chat_id -> texts to send, in order.
+    """
+    merged = dict()  # chat_id -> [text]
+    last_length = dict()  # chat_id -> UTF-16 length of the last text
+    for chat_id, message in batch:
+        texts = merged.setdefault(chat_id, [])
+        length = __utf16_length(message)
+        if texts and last_length[chat_id] + 1 + length <= TELEGRAM_MAX_MESSAGE_LENGTH:
+            texts[-1] += '\n' + message
+            last_length[chat_id] += 1 + length
+        else:
+            texts.append(message)
+            last_length[chat_id] = length
+    return merged
+
+
+async def __send_to_chat(chat_id, texts):
+    loop = asyncio.get_running_loop()
+    for text in texts:
+        try:
+            # `bot.send_message` is blocking, run it in a sender thread to keep the event loop free
+            await loop.run_in_executor(sender_executor, partial(bot.send_message, chat_id=chat_id, text=text))
+        except Exception as e:
+            logger.getChild('outbox-pump').error('Failed to send message to chat %s: %s', chat_id, e)
+
+
+async def __outbox_pump():
+    """
+    Drain the outbox. Messages arriving within a short window are collected into one batch,
+    those to the same chat are merged, and different chats are sent to concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await outbox.get()]
+        deadline = loop.time() + OUTBOX_WINDOW_SECONDS
+        while len(batch) < OUTBOX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(outbox.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await asyncio.gather(
+                *(__send_to_chat(chat_id, texts) for chat_id, texts in __merge_messages(batch).items()))
+        except Exception as e:
+            logger.getChild('outbox-pump').error('Failed to send a batch of %s message(s): %s', len(batch), e)
+        finally:
+            for _ in batch:
+                outbox.task_done()  # lets the shutdown wait until everything queued has been sent
 
 
 def __get_greeting_str():
@@ -257,65 +418,130 @@ def __get_greeting_str():
     return greeting
 
 
-def stop():
+def __shutdown():
     """
-    Stop kimikuri.
+    Stop internal threads and write pending modifications back. Does nothing if called again.
     """
     global kimikuri_running
-    print('Stopping...')
+    if not kimikuri_running:
+        return
     kimikuri_running = False  # set main running flag to false
-    __save_database_loop_interrupt_event.set()  # interrupt database saving loop
-    updater.stop() if updater else None  # stop bot updater
+    # stop handling updates first, so no registration comes after the final snapshot
     dispatcher.stop()  # stop bot dispatcher
+    if config.use_webhook():
+        webhook_dispatcher_thread.join()  # the running flag is checked at least once per second
+    __save_database()  # save pending modifications before quitting
+    database.close()
+    # may block until the pending long poll returns, so do it after everything has been saved
+    updater.stop() if updater else None  # stop bot updater
+    sender_executor.shutdown(wait=False)
+
+
+def stop():
+    """
+    Stop kimikuri.
+    """
+    print('Stopping...')
+    __shutdown()
     exit(0)
 
 
 greeting_string = __get_greeting_str()
+greeting_response = HTMLResponse(content=greeting_string)  # encoded once, served as is
+send_message_success_response = ORJSONResponse({'success': True})
+send_message_failure_response = ORJSONResponse({'success': False})
+
+
+def __recognize_bot():
+    """
+    Fetch (and cache in `bot`) the bot's own identity.
+    This blocks on Telegram, run it in a sender thread to keep the startup going.
+    """
+    logger.info('Connecting to Telegram...')
+    try:
+        me = bot.get_me()
+        logger.info('Recognized bot as %s.', me.username)
+    except Exception as e:
+        logger.error('Failed to get bot information from Telegram: %s', e)
 
 
 # register FastAPI handlers
+@webapi.on_event('startup')
+async def webapi_startup():
+    global outbox, outbox_pump_task
+    outbox = asyncio.Queue()
+    outbox_pump_task = asyncio.create_task(__outbox_pump())
+    sender_executor.submit(__recognize_bot)
+
+
+@webapi.on_event('shutdown')
+async def webapi_shutdown():
+    # `/message` has already acknowledged the queued messages, send them before quitting
+    if not outbox_pump_task.done():
+        try:
+            await asyncio.wait_for(outbox.join(), OUTBOX_DRAIN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning('Timed out sending queued messages, %s message(s) are dropped.', outbox.qsize())
+    outbox_pump_task.cancel()
+    # when served by an external uvicorn (e.g. in Docker), this is the only chance to save the database
+    await asyncio.get_running_loop().run_in_executor(None, __shutdown)  # blocking, keep it off the event loop
+
+
 @webapi.get('/', response_class=HTMLResponse)
 async def webapi_root():
-    return greeting_string
+    return greeting_response
 
 
 @webapi.get('/' + API_SEND_MESSAGE)
 async def webapi_send_message(token: str, message: str):
-    return {'success': bool(notify(token, message))}
+    return send_message_success_response if notify(token, message) else send_message_failure_response
 
 
 @webapi.post(f'/{webhook_secret}')
 async def webapi_webhook(request: fastapi.Request):
     if not config.use_webhook():
         return {'message': 'Uh, uhh. This makes no sense.'}  # filter out undesired requests
-    json_body = await request.json()
-    logger.debug(f'WebHook request: {json_body}')
-    webhook_update_queue.put(Update.de_json(json_body, bot))
+    json_body = orjson.loads(await request.body())
+    logger.debug('WebHook request: %s', json_body)
+    try:
+        webhook_update_queue.put_nowait(json_body)
+    except Full:
+        logger.warning('WebHook update queue is full, rejecting the update.')
+        raise HTTPException(status_code=503)
 
 
 # start polling or register webhook
 if config.use_webhook():
     logger.info('Registering WebHook...')
     webhook_addr = config.get_webhook_base() + webhook_secret
-    logger.debug(f'Previous WebHook status: {bot.get_webhook_info()}')
+    if logger.isEnabledFor(logging.DEBUG):  # skip the round trip to Telegram unless it is logged
+        logger.debug(f'Previous WebHook status: {bot.get_webhook_info()}')
     bot.delete_webhook(drop_pending_updates=True)
     if cert_file_name := config.get_webhook_cert_file_name():
         cert = open(cert_file_name, 'rb')
     else:
         cert = None
-    bot.set_webhook(url=webhook_addr, certificate=cert)
+    bot.set_webhook(url=webhook_addr, certificate=cert,
+                    max_connections=config.get_webhook_max_connections(), allowed_updates=BOT_ALLOWED_UPDATES)
     if isinstance(cert, IO):
         cert.close()
-    logger.debug(f'Current WebHook status: {bot.get_webhook_info()}')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f'Current WebHook status: {bot.get_webhook_info()}')
 else:
     logger.info('Start polling...')
     assert updater is not None, 'Updater should have been initialized in polling mode.'
-    updater.start_polling()
+    # long polling, so an idle bot makes a request every `timeout` seconds, rather than every 10 seconds
+    updater.start_polling(poll_interval=0.0, timeout=config.get_bot_polling_timeout_seconds(),
+                          allowed_updates=BOT_ALLOWED_UPDATES)
 
 
 # start internal debugging uvicorn server
 def __uvicorn_runner():
-    uvicorn.run(webapi, host=DEBUG_HOST, port=DEBUG_PORT, log_level='warning')
+    # uvicorn only sets the loop policy and then gets the current loop, which does not exist in this thread,
+    # so create the loop here and tell uvicorn to leave it alone
+    asyncio.set_event_loop(uvloop.new_event_loop())
+    uvicorn.run(webapi, host=DEBUG_HOST, port=DEBUG_PORT, loop='none', http='httptools',
+                limit_concurrency=1000, timeout_keep_alive=30, log_level='warning')
 
 
 if __name__ == "__main__":
@@ -325,11 +551,21 @@ if __name__ == "__main__":
         uvicorn_thread = Thread(target=__uvicorn_runner)
         uvicorn_thread.setName('UvicornRunner')
         uvicorn_thread.setDaemon(True)
-        uvicorn_thread.start()
+        uvicorn_thread.start()  # the bot is recognized on its startup
+    else:
+        sender_executor.submit(__recognize_bot)
 
     print('Hello!')
     print(greeting_string)
 
+    if not sys.stdin.isatty():
+        # no console to read commands from (e.g. running as a service), just wait to be terminated
+        stop_event = Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+        stop_event.wait()
+        stop()
+
     try:
         while True:
             inp = input('>>>')
@@ -346,12 +582,10 @@ if __name__ == "__main__":
             elif inp_lower == 'users':
                 users = database.get_users()
                 print('Users:')
-                counter = 0
                 for user in users:
                     print(f'User ID: {user.user_id}, Chat ID: {user.chat_id}, Token: {user.token}')
-                    counter += 1
-                if counter:
-                    print(f'{counter} user(s) totally.')
+                if users:
+                    print(f'{len(users)} user(s) totally.')
                 else:
                     print('(no user registered)')
             else:
@@ -0,0 +1,26 @@
+import logging
+from logging import FileHandler
+
+
+class BufferedFileHandler(FileHandler):
+    """
+    A FileHandler which does not flush the file after every record.
+    Records stay in the file buffer until it is full, `flush` is called,
+    or a record at or above `flush_level` is emitted.
+    """
+
+    def __init__(self, filename, flush_level=logging.ERROR, **kwargs):
+        FileHandler.__init__(self, filename, **kwargs)
+        self.__flush_level = flush_level
+
+    def emit(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= self.__flush_level:
+                self.flush()
+        except RecursionError:
+            raise
+        except Exception:
+            self.handleError(record)
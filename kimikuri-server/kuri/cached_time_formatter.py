@@ -0,0 +1,24 @@
+import time
+from logging import Formatter
+
+
+class CachedTimeFormatter(Formatter):
+    """
+    A Formatter which formats the time of each second only once,
+    since records logged in a burst usually share the same second.
+    Only the default time format is cached, a custom `datefmt` is formatted as usual.
+    """
+
+    def __init__(self, *args, **kwargs):
+        Formatter.__init__(self, *args, **kwargs)
+        self.__cache = (None, None)  # (second, formatted time)
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt:
+            return Formatter.formatTime(self, record, datefmt)
+        second = int(record.created)
+        cached_second, t = self.__cache
+        if second != cached_second:
+            t = time.strftime(self.default_time_format, self.converter(second))
+            self.__cache = (second, t)
+        return self.default_msec_format % (t, record.msecs)
@@ -1,7 +1,6 @@
 import logging
 
-from telegram import Update
-from telegram.ext import Dispatcher, CommandHandler, CallbackContext
+from telegram.ext import Dispatcher, CommandHandler, Filters, BaseFilter
 
 
 class CommandRegister:
@@ -12,12 +11,13 @@ class CommandRegister:
     def __init__(self, dispatcher: Dispatcher):
         self.__dispatcher = dispatcher
 
-    def command(self, name: str, description: str):
+    def command(self, name: str, description: str, filters: BaseFilter = None):
         """
         The decorator that marks a function as a bot command handler function.
         Just use this like Flask's `app.get` or `app.post`.
         :param name: the command's full name.
         :param description: description of this command.
+        :param filters: only updates passing these filters are handled.
         :return: the desired function wrapper. The command will be registered once the wrapper is called.
         """
 
@@ -30,7 +30,7 @@ class CommandRegister:
             if name in self.__registered_commands.keys():
                 self.__logger.error(f'Command `{name}` has already been registered. Cannot register more than once.')
             else:
-                self.__dispatcher.add_handler(CommandHandler(name, func))
+                self.__dispatcher.add_handler(CommandHandler(name, func, filters=filters))
                 self.__registered_commands[name] = {'description': description}
                 self.__logger.debug(f'Registered command {name}.')
             return func
@@ -47,27 +47,8 @@ class CommandRegister:
         :return: the desired function wrapper. The command will be registered once the wrapper is called.
         """
 
-        if not isinstance(name, str):
-            raise ValueError('Invalid command name.')
-        if not isinstance(description, str):
-            raise ValueError('Invalid command description.')
-
-        outer_wrapper = self.command(name, description)
-
-        def user_command_wrapper(func):
-            def wrapper_func(update: Update, context: CallbackContext):
-                if 'message' not in dir(update):
-                    return
-                if 'from_user' not in dir(update.message):
-                    return
-                func(update, context)
-
-            return wrapper_func
-
-        def compounded_wrapper(outer, inner):
-            return lambda func: outer(inner(func))
-
-        return compounded_wrapper(outer_wrapper, user_command_wrapper)
+        # new (non-edited) messages, which always come with a sender, unlike channel posts
+        return self.command(name, description, filters=Filters.update.message)
 
     def get_manual_string(self) -> str:
         """
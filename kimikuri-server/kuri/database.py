@@ -1,73 +1,164 @@
-import json
-from threading import Lock
-from typing import Optional, Iterator
+import logging
+import os
+from hashlib import blake2b
+from dataclasses import dataclass
+from threading import RLock, Lock, Event
+from typing import Optional, List
 
+import orjson
 
+
+def _fsync_directory(file_name: str):
+    """
+    Flush the directory entry of a file to disk, e.g. after it is created or renamed.
+    """
+    if os.name != 'posix':
+        return  # directories cannot be opened (nor synced) on Windows
+    fd = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@dataclass(frozen=True)
 class UserDict:
     """
     The user data structure used in Database internal.
+    Instances are immutable, so they can be handed out without copying.
     """
+    __slots__ = ('user_id', 'token', 'chat_id')
 
-    def __init__(self, user_id=None, token=None, chat_id=None):
-        if not user_id:
+    user_id: int
+    token: str
+    chat_id: int
+
+    def __post_init__(self):
+        if not self.user_id:
             raise ValueError('Invalid user_id')
-        if not token:
+        if not self.token:
             raise ValueError('Invalid token')
-        if not chat_id:
+        if not self.chat_id:
             raise ValueError('Invalid chat_id')
-        self.user_id = user_id
-        self.token = token
-        self.chat_id = chat_id
-
-    def to_dict(self) -> dict:
-        return {
-            'user_id': self.user_id,
-            'token': self.token,
-            'chat_id': self.chat_id
-        }
-
-    @staticmethod
-    def from_dict(d: dict):
-        return UserDict(d['user_id'], d['token'], d['chat_id'])
 
 
 class KuriDatabase:
     """
     The ORM for Kimikuri.
+    Readers are lock-free (a single `dict.get` is atomic under the GIL);
+    writers serialize on the write lock.
+    If a write-ahead log (WAL) file is given, every registration is appended to it and synced
+    before being visible, so `save` only has to be called now and then to compact the log into a snapshot.
     """
-    __users_by_token = dict()  # token -> user_dict
-    __users_by_user_id = dict()  # user_id -> user_dict
-
-    __lock_user_structure = Lock()  # lock for two dicts above
-    __lock_is_user_registered = Lock()
-    __lock_register = Lock()
+    __logger = logging.getLogger('kimikuri.database')
 
-    __dirty = False
+    def __init__(self, wal_file_name: str = None):
+        self.__users_by_token = dict()  # token -> user_dict
+        self.__users_by_user_id = dict()  # user_id -> user_dict
+        self.__token_to_chat_id = dict()  # token -> chat_id, for the `/message` hot path
+        self.__reserved_tokens = dict()  # tokens handed out but not registered yet
+        self.__write_lock = RLock()  # held only while mutating the dicts above
+        self.__save_lock = Lock()  # serializes concurrent `save` calls
+        self.__dirty = False
+        self.__dirty_event = Event()  # set on every modification, used to wake up the saver
+        self.__wal = None  # append-only log of registrations since the last snapshot
+        self.__wal_records = 0  # count of records in the WAL
+        self.__snapshot_digest = None  # digest of the snapshot on disk, if known
+        if wal_file_name:
+            self.__open_wal(wal_file_name)
 
     @staticmethod
-    def from_file(fp):
+    def from_file(fp, wal_file_name: str = None):
         """
         Load serialized (array-like) database from file.
+        The file must be opened in binary mode.
+        :param wal_file_name: the WAL to replay on top of the snapshot, and to append further registrations to.
         """
-        j = json.load(fp)
+        data = fp.read()
+        j = orjson.loads(data)
         if not isinstance(j, list):
             raise ValueError('JSON object must be a list')
         db = KuriDatabase()
+        db.__snapshot_digest = blake2b(data).digest()
         for d in j:
-            user = UserDict.from_dict(d)
-            db.__users_by_token[user.token] = user
-            db.__users_by_user_id[user.user_id] = user
+            db.__index_user(UserDict(d['user_id'], d['token'], d['chat_id']))
+        if wal_file_name:
+            db.__open_wal(wal_file_name)
         return db
 
-    def to_file(self, fp):
+    def __open_wal(self, wal_file_name: str):
         """
-        Save database to file.
+        Replay the WAL on top of the loaded snapshot, then open it for appending.
         """
+        replayed = 0
+        valid_length = 0  # length of the leading intact records
+        if os.path.isfile(wal_file_name):
+            with open(wal_file_name, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('Incomplete record')
+                        d = orjson.loads(line)
+                        user = UserDict(d['user_id'], d['token'], d['chat_id'])
+                    except (ValueError, KeyError, TypeError) as e:
+                        self.__logger.warning(f'Ignored broken WAL record at offset {valid_length}: {e}')
+                        break
+                    valid_length += len(line)
+                    self.__wal_records += 1
+                    if user.user_id not in self.__users_by_user_id:  # may have been saved in the snapshot already
+                        self.__index_user(user)
+                        replayed += 1
+        self.__wal = open(wal_file_name, 'ab', buffering=0)
+        self.__wal.truncate(valid_length)  # drop the torn tail left by a crash, if any
+        if replayed:
+            self.__logger.info(f'Replayed {replayed} registration(s) from WAL.')
+            self.__dirty = True
+            self.__dirty_event.set()
 
-        with self.__lock_user_structure:
-            l = [x.to_dict() for x in self.__users_by_token.values()]
-        json.dump(l, fp, indent=4)
-        self.__dirty = False
+    def save(self, file_name: str):
+        """
+        Save database to the given file atomically, and truncate the WAL.
+        The data is written into a temporary file first, which then replaces the target,
+        so a crash during saving never leaves a half-written database behind.
+        """
+        tmp_file_name = file_name + '.tmp'
+        with self.__save_lock:
+            # only take the snapshot under the write lock, serializing and writing below run without it,
+            # so registrations never wait for the disk
+            with self.__write_lock:
+                users = list(self.__users_by_token.values())
+                wal_records = self.__wal_records
+                self.__dirty = False
+            try:
+                data = orjson.dumps(users)  # orjson serializes dataclasses natively
+                digest = blake2b(data).digest()
+                if digest != self.__snapshot_digest:  # skip writing if nothing has changed on disk
+                    with open(tmp_file_name, 'wb') as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())  # the snapshot must be durable before the WAL is dropped
+                    os.replace(tmp_file_name, file_name)
+                    _fsync_directory(file_name)  # make the rename itself durable
+                    self.__snapshot_digest = digest
+            except Exception:
+                self.__dirty = True
+                raise
+            with self.__write_lock:
+                # if someone registered during writing, keep the WAL, since the snapshot misses that record
+                # (replaying the records which are already in the snapshot is harmless)
+                if self.__wal and self.__wal_records == wal_records:
+                    self.__wal.truncate(0)
+                    os.fsync(self.__wal.fileno())
+                    self.__wal_records = 0
+
+    def close(self):
+        """
+        Close the WAL. The database must not be modified afterwards.
+        """
+        with self.__write_lock:
+            if self.__wal:
+                self.__wal.close()
+                self.__wal = None
 
     def is_dirty(self):
         """
@@ -75,52 +166,100 @@ class KuriDatabase:
         """
         return self.__dirty
 
+    def get_wal_record_count(self) -> int:
+        """
+        Count of registrations logged in the WAL since it was truncated by the last `save`.
+        """
+        return self.__wal_records
+
+    def wait_dirty(self, timeout: float = None) -> bool:
+        """
+        Block until the database is modified, then reset the notification.
+        :param timeout: max seconds to wait. Wait forever if it is None.
+        :return: if the database was modified during waiting.
+        """
+        modified = self.__dirty_event.wait(timeout)
+        self.__dirty_event.clear()
+        return modified
+
     def is_user_registered(self, user_id=None, token=None) -> bool:
         """
         Either `user_id` or `token` should be present.
         """
-        with self.__lock_is_user_registered:
-            if not user_id and not token:
-                raise ValueError('Either `user_id` or `token` should be present.')
-            if user_id and token:
-                user_dict = self.__users_by_user_id.get(user_id)
-                return isinstance(user_dict, UserDict) and user_dict.token == token
-            if user_id:
-                return isinstance(self.__users_by_user_id.get(user_id), UserDict)
-            if token:
-                return isinstance(self.__users_by_token.get(token), UserDict)
+        if not user_id and not token:
+            raise ValueError('Either `user_id` or `token` should be present.')
+        if user_id and token:
+            user_dict = self.__users_by_user_id.get(user_id)
+            return isinstance(user_dict, UserDict) and user_dict.token == token
+        if user_id:
+            return isinstance(self.__users_by_user_id.get(user_id), UserDict)
+        if token:
+            return isinstance(self.__users_by_token.get(token), UserDict)
 
     def register(self, user_id=None, token=None, chat_id=None):
         """
         Register a user with given `user_id` and token.
+        The token's reservation, if any, is released whether the registration succeeds or not.
         """
-        with self.__lock_register:
-            if self.is_user_registered(user_id=user_id):
-                raise ValueError('Given user is already registered.')
-            if self.is_user_registered(token=token):
-                raise ValueError('Given token is already taken.')
-            user = UserDict(user_id=user_id, token=token, chat_id=chat_id)
-            with self.__lock_user_structure:
-                self.__users_by_token[token] = user
-                self.__users_by_user_id[user_id] = user
+        with self.__write_lock:
+            try:
+                if user_id in self.__users_by_user_id:
+                    raise ValueError('Given user is already registered.')
+                if token in self.__users_by_token:
+                    raise ValueError('Given token is already taken.')
+                user = UserDict(user_id=user_id, token=token, chat_id=chat_id)
+                if self.__wal:
+                    self.__wal.write(orjson.dumps(user) + b'\n')
+                    os.fsync(self.__wal.fileno())
+                    self.__wal_records += 1
+                self.__index_user(user)
                 self.__dirty = True
+                self.__dirty_event.set()
+            finally:
+                self.__reserved_tokens.pop(token, None)
+
+    def reserve_token(self, token: str):
+        """
+        Mark a token as taken, so that it will not be handed out twice.
+        This is lock-free, since `dict.setdefault` is atomic under the GIL.
+        :raises ValueError: if the token has already been registered or reserved.
+        """
+        marker = object()
+        if token in self.__users_by_token or self.__reserved_tokens.setdefault(token, marker) is not marker:
+            raise ValueError('Given token is already taken.')
 
     def get_user(self, user_id=None, token=None) -> Optional[UserDict]:
         if user_id:
-            d = self.__users_by_user_id.get(user_id)
+            return self.__users_by_user_id.get(user_id)
         elif token:
-            d = self.__users_by_token.get(token)
+            return self.__users_by_token.get(token)
         else:
             raise ValueError('Either user_id or token must be provided')
 
-        if isinstance(d, UserDict):
-            return UserDict.from_dict(d.to_dict())
-        else:
-            return None
+    def __index_user(self, user: UserDict):
+        self.__users_by_token[user.token] = user
+        self.__token_to_chat_id[user.token] = user.chat_id
+        self.__users_by_user_id[user.user_id] = user  # published last, so readers never see a half-registered user
 
-    def get_users(self) -> Iterator[UserDict]:
-        with self.__lock_user_structure:
-            return filter(lambda x: isinstance(x, UserDict), self.__users_by_token.values())
+    def chat_id_for(self, token: str) -> Optional[int]:
+        """
+        Get the chat to send messages to, for the user owning the given token.
+        :return: the chat id, or None if the token is not registered.
+        """
+        return self.__token_to_chat_id.get(token)
+
+    def __len__(self):
+        """
+        Count of registered users.
+        """
+        return len(self.__users_by_user_id)
+
+    def get_users(self) -> List[UserDict]:
+        """
+        Get a snapshot of all registered users.
+        """
+        with self.__write_lock:
+            return list(self.__users_by_token.values())
 
     # def get_user_token_by_user_id(self, user_id: int) -> Optional[str]:
     #     """
@@ -1,6 +1,7 @@
-import json
 from typing import Optional
 
+import orjson
+
 
 class BadConfigException(Exception):
     pass
@@ -22,16 +23,19 @@ class KuriConfig(dict):
     - bot.pool_connection_size
     - bot.connect_timeout_seconds
     - bot.read_timeout_seconds
+    - bot.polling_timeout_seconds
     - webhook
     - webhook.use_webhook
     - webhook.base * (if use_webhook is `true`)
     - webhook.cert_file
+    - webhook.max_connections
+    - webhook.queue_size
     """
 
     def __init__(self, file_name):
         dict.__init__(self)
-        with open(file_name, encoding='utf-8') as f:
-            j = json.load(f)
+        with open(file_name, 'rb') as f:
+            j = orjson.loads(f.read())
             for assertion, v in j.items():
                 self[assertion] = v
         essentials = [
@@ -44,17 +48,22 @@ class KuriConfig(dict):
                     f'{name} is not defined in configuration file. '
                 )
 
-        if self.use_webhook() and 'base' not in self.get('webhook'):
+        # sections are looked up once, accessors are called on hot paths
+        self.__bot = self.get('bot') or dict()
+        self.__webhook = self.get('webhook') or dict()
+        self.__use_webhook = bool(self.__webhook.get('use_webhook'))
+
+        if self.use_webhook() and 'base' not in self.__webhook:
             raise BadConfigException('`webhook.base` must be defined since `webhook` is set to `true`.')
 
     def is_debug_mode(self) -> bool:
         return bool(self.get('debug'))
 
     def get_bot_token(self) -> str:
-        return (self.get('bot') or dict()).get('token')
+        return self.__bot.get('token')
 
     def get_proxy_address(self) -> Optional[str]:
-        return (self.get('bot') or dict()).get('proxy')
+        return self.__bot.get('proxy')
 
     def get_log_level(self) -> str:
         """
@@ -81,7 +90,7 @@ class KuriConfig(dict):
         localhost:{your_port}/[0-9A-Za-z-._~]+, in order to let Kimikuri register
         an auto-generated secure webhook address.
         """
-        return bool((self.get('webhook') or dict()).get('use_webhook'))
+        return self.__use_webhook
 
     def get_api_base(self) -> str:
         """
@@ -92,17 +101,36 @@ class KuriConfig(dict):
         return (base + '/') if not base.endswith('/') else base
 
     def get_webhook_base(self) -> str:
-        base = str((self.get('webhook') or dict()).get('base'))
+        base = str(self.__webhook.get('base'))
         return base + ('/' if not base.endswith('/') else '')
 
     def get_webhook_cert_file_name(self) -> str:
-        return (self.get('webhook') or dict()).get('cert_file')
+        return self.__webhook.get('cert_file')
+
+    def get_webhook_max_connections(self) -> int:
+        """
+        Max simultaneous HTTPS connections Telegram opens to deliver updates to the webhook (1-100).
+        Defaults to 40, the same as Telegram's default.
+        """
+        return self.__webhook.get('max_connections') or 40
+
+    def get_webhook_queue_size(self) -> int:
+        """
+        Max count of received updates waiting to be dispatched. Further updates are rejected with 503.
+        """
+        return self.__webhook.get('queue_size') or 1000
 
     def get_pool_connection_size(self) -> int:
-        return (self.get('bot') or dict()).get('pool_connection_size') or 8
+        return self.__bot.get('pool_connection_size') or 8
 
     def get_bot_connect_timeout_seconds(self) -> int:
-        return (self.get('bot') or dict()).get('connect_timeout_seconds') or 5
+        return self.__bot.get('connect_timeout_seconds') or 5
 
     def get_bot_read_timeout_seconds(self) -> int:
-        return (self.get('bot') or dict()).get('read_timeout_seconds') or 5
+        return self.__bot.get('read_timeout_seconds') or 5
+
+    def get_bot_polling_timeout_seconds(self) -> int:
+        """
+        Timeout of long polling (`getUpdates`) in polling mode. Telegram allows 50 seconds at most.
+        """
+        return self.__bot.get('polling_timeout_seconds') or 50
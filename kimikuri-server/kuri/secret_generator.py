@@ -1,5 +1,5 @@
 import base64
-import os
+import secrets
 
 
 def safe_base64_encode(__bytes):
@@ -20,7 +20,10 @@ def safe_base64_decode(string):
 
 
 def generate_secret(secret_bytes: int = 128):
-    return safe_base64_encode(os.urandom(secret_bytes))
+    """
+    Generate a url-safe base64 encoded secret without padding.
+    """
+    return secrets.token_urlsafe(secret_bytes).encode('ascii')
 
 
 if __name__ == '__main__':